@@ -1,6 +1,6 @@
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-import binascii
 import json
 import os
 import signal
@@ -36,6 +36,10 @@ FILEPRIVATEKEY = '../keys/client_localhost.pem'
 FILECERTIFICATE = '../certificates/client_localhost.crt'
 MAXDOWNLOADERRORS = 20
 
+# Keep-alive connection pool shared by every request to the server
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+
 class MediaClient:
 
     # Constructor
@@ -65,7 +69,7 @@ class MediaClient:
 
         # 1. Get DH parameters from server
         _, headers = self.processRequest({}, cipher=False)
-        req = requests.get(f'{self.SERVER_URL}/api/parameters', headers = headers)
+        req = SESSION.get(f'{self.SERVER_URL}/api/parameters', headers = headers)
         data = self.processResponse(
             request = req,
             ciphered = False
@@ -84,6 +88,8 @@ class MediaClient:
         # Initialize other vars
         self.sessionid = None
         self.shared_key = None
+        self.algorithm = None
+        self.key_context = None
         self.CIPHER = None
         self.DIGEST = None
         self.CIPHERMODE = None
@@ -98,7 +104,7 @@ class MediaClient:
         # 1. Let user choose chipher suite
         # 1.1. Ask server for available protocols 
         _, headers = self.processRequest({}, cipher=False)
-        req = requests.get(f'{self.SERVER_URL}/api/protocols', headers = headers)            
+        req = SESSION.get(f'{self.SERVER_URL}/api/protocols', headers = headers)            
         data = self.processResponse(
             request = req,
             ciphered = False
@@ -119,7 +125,7 @@ class MediaClient:
         )
         data = cipherSuite
         data['public_key'] = pk.decode('utf-8') 
-        req = requests.post(f'{self.SERVER_URL}/api/session', data=data)
+        req = SESSION.post(f'{self.SERVER_URL}/api/session', data=data)
         reqdata = self.processResponse(
             request = req,
             ciphered = False
@@ -135,6 +141,10 @@ class MediaClient:
 
         # 2.2. Generate the shared key based on the server public key
         self.shared_key = self.private_key.exchange(server_public_key)
+        # 2.3. Build the cipher (and its key) once for the whole session
+        self.algorithm = CryptoFunctions.cipherAlgorithm(self.shared_key, self.CIPHER, self.DIGEST)
+        # 2.4. Digest the shared key once, to derive the keys with bytes appended
+        self.key_context = CryptoFunctions.digestContext(self.shared_key, self.DIGEST)
 
     def run(self):
         # 1. Validate that client has already been started
@@ -211,7 +221,7 @@ class MediaClient:
             if not password: break
             # Create digest for password
             if not registration:
-                passwordDigest = CryptoFunctions.create_digest(password.encode('latin'), self.DIGEST).decode('latin')
+                passwordDigest = CryptoFunctions.create_digest(password.encode('latin'), self.DIGEST).hex()
             else:
                 passwordDigest = password
             # Sign username+password
@@ -224,7 +234,7 @@ class MediaClient:
                 payload['intermedium'] = [c.public_bytes(serialization.Encoding.DER).decode('latin') for c in cc.intermedium]
             data, headers  = self.processRequest(payload)
             # POST to server
-            req = requests.post(url, data = data, headers = headers)
+            req = SESSION.post(url, data = data, headers = headers)
             # Process server response
             reqResp = self.processResponse(request = req)
             if req.status_code != 200:
@@ -242,7 +252,7 @@ class MediaClient:
         # 1. Get a list of media files
         _, headers = self.processRequest({}, cipher=False)
         headers ['sessionid'] = base64.b64encode(self.sessionid.bytes)
-        req = requests.get(f'{SERVER_URL}/api/list', headers = headers)
+        req = SESSION.get(f'{SERVER_URL}/api/list', headers = headers)
         reqResp = self.processResponse(req)
         if req.status_code != 200:
             self.responseError(req, reqResp)
@@ -290,8 +300,9 @@ class MediaClient:
             for i in range(0,5):
                 data, headers  = self.processRequest({"media": media_item["id"], "chunk": chunk})
                 # POST to server
-                req = requests.post(f'{self.SERVER_URL}/api/download', data = data, headers = headers)
-                media = self.processResponse(req, bytes(chunk))
+                req = SESSION.post(f'{self.SERVER_URL}/api/download', data = data, headers = headers)
+                # Chunks come as raw bytes, errors as JSON
+                media = self.processResponse(req, chunk.to_bytes(4, 'big'), raw = req.status_code == 200)
 
                 if req.status_code != 200:
                     self.responseError(req, media)
@@ -300,7 +311,7 @@ class MediaClient:
                 if media:
                     break
 
-            if not media or 'error' in media:
+            if not media or req.status_code != 200:
                 self.downloadErrors += 1
                 if self.downloadErrors > MAXDOWNLOADERRORS:
                     print("\nReached max download errors, aborting media play...")
@@ -309,9 +320,8 @@ class MediaClient:
                     break
                 continue
 
-            data = binascii.a2b_base64(media['data'].encode('latin'))
             try:
-                proc.stdin.write(data)
+                proc.stdin.write(media)
             except:
                 break
 
@@ -321,7 +331,7 @@ class MediaClient:
         """
         data, headers  = self.processRequest({"logout": True})
         # POST to server
-        req = requests.post(f'{self.SERVER_URL}/api/auth', data = data, headers = headers)
+        req = SESSION.post(f'{self.SERVER_URL}/api/auth', data = data, headers = headers)
         # Process server response
         reqResp = self.processResponse(request = req)
         if req.status_code != 200:
@@ -336,7 +346,7 @@ class MediaClient:
         """
         _, headers = self.processRequest({}, cipher=False)
         headers['sessionid'] = base64.b64encode(self.sessionid.bytes)
-        req = requests.get(f'{SERVER_URL}/api/license', headers = headers)
+        req = SESSION.get(f'{SERVER_URL}/api/license', headers = headers)
         reqResp = self.processResponse(req)
         if req.status_code != 200:
             self.responseError(req, reqResp)
@@ -351,7 +361,7 @@ class MediaClient:
         """
         data, headers  = self.processRequest({"renew": True})
         # POST to server
-        req = requests.post(f'{self.SERVER_URL}/api/renew', data = data, headers = headers)
+        req = SESSION.post(f'{self.SERVER_URL}/api/renew', data = data, headers = headers)
         # Process server response
         reqResp = self.processResponse(request = req)
         if req.status_code != 200:
@@ -369,7 +379,7 @@ class MediaClient:
         """
         data, headers  = self.processRequest({"close": True})
         # POST to server
-        req = requests.post(f'{self.SERVER_URL}/api/sessionend', data = data, headers = headers)
+        req = SESSION.post(f'{self.SERVER_URL}/api/sessionend', data = data, headers = headers)
         # Process server response
         reqResp = self.processResponse(request = req)
         if req.status_code != 200:
@@ -417,18 +427,18 @@ class MediaClient:
 
         if cipher:
             cryptogram = CryptoFunctions.symetric_encryption(
-                key = self.shared_key,
                 message = message,
                 algorithm_name = self.CIPHER,
                 cypher_mode = self.CIPHERMODE,
                 digest_mode = self.DIGEST,
-                encode = True
+                encode = True,
+                algorithm = self.algorithm
             )
         else:
             cryptogram = message
 
         if cipher:
-            MIC = CryptoFunctions.create_digest(cryptogram, self.DIGEST).strip()
+            MIC = CryptoFunctions.create_mic(cryptogram, self.DIGEST, self.CIPHERMODE).strip()
             MAC = CryptoFunctions.create_digest(cryptogram+self.shared_key, self.DIGEST).strip()
         
         SIGN = CryptoFunctions.signingRSA(cryptogram, self.cert_private_key)
@@ -447,16 +457,17 @@ class MediaClient:
         return cryptogram, headers
     
     # Response
-    def processResponse(self, request, append=None, ciphered=True):
+    def processResponse(self, request, append=None, ciphered=True, raw=False):
         """
         Processes a request response
         Validates the MIC sent on the header 
         --- Parameters
         request     
-        append      Bytes to append to shared_key before decyphering
+        append      Bytes appended to shared_key to get the key for decyphering
         ciphered    If response must be ciphered!
+        raw         If the payload is raw bytes instead of JSON
         --- Returns
-        payload     The payload (Python obj) of the request deciphered (if the case) and validated (the MIC)
+        payload     The payload (Python obj, or bytes if raw) of the request deciphered (if the case) and validated (the MIC)
         """
         if not request.content: return None
 
@@ -471,7 +482,7 @@ class MediaClient:
 
         # Validate MIC
         if ciphered:
-            MIC = CryptoFunctions.create_digest(request.content.strip(), self.DIGEST)
+            MIC = CryptoFunctions.create_mic(request.content.strip(), self.DIGEST, self.CIPHERMODE)
             if MIC != base64.b64decode(request.headers['Mic']):
                 print("INVALID MIC!")
                 return None
@@ -498,14 +509,21 @@ class MediaClient:
         if not ciphered:
             message = request.content
         else:
+            # Get cipher for the key (shared_key, or shared_key + append)
+            if not append:
+                algorithm = self.algorithm
+            else:
+                algorithm = CryptoFunctions.appendedCipherAlgorithm(self.key_context, append, self.CIPHER, self.DIGEST)
             message = CryptoFunctions.symetric_encryption( 
-                key = self.shared_key if not append else self.shared_key + append, 
                 message = request.content, 
                 algorithm_name = self.CIPHER, 
                 cypher_mode = self.CIPHERMODE, 
                 digest_mode = self.DIGEST, 
-                encode = False 
+                encode = False,
+                algorithm = algorithm
             ) 
+        if raw:
+            return message
         # Convert message bytes to str and to Python Object
         try:
             return json.loads(message.decode()) 
@@ -13,10 +13,14 @@ class CryptoFunctions:
     suites = [
         'AES / CBC / SHA512',
         'AES / OFB / SHA512',
+        'AES / GCM / SHA512',
         '3DES / CBC / BLAKE2',
         '3DES / OFB / BLAKE2',
     ]
     digests = ['SHA512', 'BLAKE2']
+    # GCM nonce and authentication tag sizes (bytes)
+    GCM_IV_LENGTH = 12
+    GCM_TAG_LENGTH = 16
 
     """
     This method handles the creation of private/public keys pair
@@ -39,67 +43,70 @@ class CryptoFunctions:
     """
     @staticmethod
     def create_digest(message, digst_algorithm):
-        hash_algorithm = None
-        
+        return CryptoFunctions.digestContext(message, digst_algorithm).finalize()
+
+    @staticmethod
+    def digestContext(message, digst_algorithm):
+        """
+        This method creates a digest context already fed with a message
+        Copies of it give the digest of messages starting with those bytes
+        --- Returns
+        context     hashes.Hash
+        """
         if digst_algorithm == "SHA512":
-            hash_algorithm = hashes.SHA512_256()
+            context = hashes.Hash(hashes.SHA512_256())
         elif digst_algorithm == "BLAKE2":
-            hash_algorithm = hashes.BLAKE2b(64)
+            context = hashes.Hash(hashes.BLAKE2b(64))
         else:
             raise Exception("Digest Algorithm name not found!")
-        
-        digest = hashes.Hash(hash_algorithm)
-        digest.update(message)
-        
-        return digest.finalize()
+        context.update(message)
+        return context
 
     """
     This method handles symetric encryption/decription
     --- Parameters
-    key             String      The key to use on encription/decription
     message         Bytes       The text to encrypt/crytpogram to decript
     algorithm_name  String      AES or 3DES
-    cypher_mode     String      CBC or OFB
+    cypher_mode     String      CBC, OFB or GCM (AES only, the tag is saved at the end)
     digest_mode     String      SHA512 or BLAKE2
     encode          bool        True for encription and False for decription
+    key             String      The key to use on encription/decription (if no algorithm is given)
+    algorithm       Algorithm   Built by cipherAlgorithm for the key (if no key is given)
     --- Returns
     criptograma     Bytes       Criptogram for encription and plain text for decription
     """
     @staticmethod
-    def symetric_encryption(key,message, algorithm_name, cypher_mode, digest_mode, encode=True ):
+    def symetric_encryption(message, algorithm_name, cypher_mode, digest_mode, encode=True, key=None, algorithm=None ):
 
         # Define algorithm
-        algorithm = None
-        blockLength = 0
+        if algorithm == None:
+            algorithm = CryptoFunctions.cipherAlgorithm(key, algorithm_name, digest_mode)
+        # Divide by 8 because it returns size on bits and we want on bytes (8 bits)
+        blockLength = algorithm.block_size // 8
+        ivLength = CryptoFunctions.GCM_IV_LENGTH if cypher_mode == "GCM" else blockLength
         iv = None
 
-        if algorithm_name == "AES":
-            key = CryptoFunctions.validateKey(key, digest_mode, 256)
-            algorithm = algorithms.AES(key)
-            # Divide by 8 because it returns size on bits and we want on bytes (8 bits)
-            blockLength = algorithms.AES.block_size // 8
-            
-        elif algorithm_name == "3DES":
-            key = CryptoFunctions.validateKey(key, digest_mode, 192)
-            algorithm = algorithms.TripleDES(key[:24])
-            blockLength = algorithm.block_size // 8
-            
-        else:
-            raise Exception("Algorithm not found!")
-
         # Generate initialization vector
         if encode and iv == None:
-            iv = os.urandom(blockLength)
+            iv = os.urandom(ivLength)
         # On decription, get IV
         else:
-            iv = message[0:blockLength]
-            message = message[blockLength:]
+            iv = message[0:ivLength]
+            message = message[ivLength:]
 
         # Initialize Cipher with user chosen algorithm and Cipher Block Chaining mode
         if cypher_mode == "CBC":
             cipher = Cipher(algorithm, modes.CBC(iv))
         elif cypher_mode == "OFB":
             cipher = Cipher(algorithm,  modes.OFB(iv))
+        elif cypher_mode == "GCM":
+            # On decription, get tag at the end
+            if encode:
+                cipher = Cipher(algorithm, modes.GCM(iv))
+            else:
+                tag = message[-CryptoFunctions.GCM_TAG_LENGTH:]
+                message = message[:-CryptoFunctions.GCM_TAG_LENGTH]
+                cipher = Cipher(algorithm, modes.GCM(iv, tag))
         else:
             raise Exception("Cypher mode not found!")
 
@@ -109,28 +116,28 @@ class CryptoFunctions:
         else:
             cryptor = cipher.decryptor()
 
-        criptograma = b""
+        # GCM is a stream mode, so it needs no padding
+        if cypher_mode == "GCM":
+            criptograma = cryptor.update(message) + cryptor.finalize()
+            # On encription, save IV at the beggining and tag at the end
+            if encode:
+                criptograma = iv + criptograma + cryptor.tag
+            return criptograma
+
+        # On encription, add padding to complete the last block
+        if encode:
+            padding_length = blockLength - len(message) % blockLength
+            message += bytes([padding_length] * padding_length)
+        # On decription, ignore an incomplete last block
+        else:
+            message = message[:len(message) - len(message) % blockLength]
+
+        # Process all blocks at once and finalyze
+        criptograma = cryptor.update(message) + cryptor.finalize()
 
         # On encription, save IV at the beggining
         if encode:
-            criptograma += iv
-
-        # Iterate over blocks
-        for i in range(0,len(message)+1,blockLength):
-            data = message[i:i+blockLength] if i < len(message) else b''
-            # If data has block size, just encrypt
-            if len(data) == blockLength:
-                criptograma += cryptor.update(data)
-            # If smaller, reached end, add/remove padding and finalyze
-            else:
-                # On encription, save IV at the beggining
-                if encode:
-                    padding_length = blockLength - len(data)
-                    padding = [padding_length] * (padding_length)
-                    criptograma += cryptor.update(data + bytes(padding))
-    
-        # Add finalization on both modes
-        criptograma += cryptor.finalize()
+            criptograma = iv + criptograma
 
         # If decripting, remove padding
         if not encode:
@@ -138,6 +145,71 @@ class CryptoFunctions:
         
         return criptograma
 
+    @staticmethod
+    def create_mic(cryptogram, digest_mode, cypher_mode):
+        """
+        This method creates the MIC for a cryptogram
+        On GCM it is the authentication tag (already computed on encription),
+        otherwise it is a digest of the cryptogram
+        --- Returns
+        MIC         bytes
+        """
+        if cypher_mode == "GCM":
+            return cryptogram[-CryptoFunctions.GCM_TAG_LENGTH:]
+        return CryptoFunctions.create_digest(cryptogram, digest_mode)
+
+    @staticmethod
+    def cipherKey(key, algorithm_name, digest_mode):
+        """
+        This method returns the key the cipher algorithm uses for a given key
+        It can be computed once (e.g. per session) and given to symetric_encryption,
+        which then uses it as it is
+        - Parameteres
+        key             bytes
+        algorithm_name  String      AES or 3DES
+        digest_mode     String
+        """
+        if algorithm_name == "AES":
+            return CryptoFunctions.validateKey(key, digest_mode, 256)
+        elif algorithm_name == "3DES":
+            return CryptoFunctions.validateKey(key, digest_mode, 192)[:24]
+        raise Exception("Algorithm not found!")
+
+    @staticmethod
+    def cipherAlgorithm(key, algorithm_name, digest_mode):
+        """
+        This method builds the cipher algorithm for a given key
+        It can be built once (e.g. per session) and reused for every message
+        - Parameteres
+        key             bytes
+        algorithm_name  String      AES or 3DES
+        digest_mode     String
+        """
+        key = CryptoFunctions.cipherKey(key, algorithm_name, digest_mode)
+        if algorithm_name == "AES":
+            return algorithms.AES(key)
+        return algorithms.TripleDES(key)
+
+    @staticmethod
+    def appendedCipherAlgorithm(context, append, algorithm_name, digest_mode):
+        """
+        This method builds the cipher algorithm for a key with some bytes appended,
+        given the digest context of the key (see digestContext)
+        It is the same as cipherAlgorithm(key + append, ...) without building key + append,
+        as long as key + append does not already have the cipher key size
+        - Parameteres
+        context         hashes.Hash     Digest context of the key
+        append          bytes
+        algorithm_name  String          AES or 3DES
+        digest_mode     String
+        """
+        context = context.copy()
+        context.update(append)
+        key = context.finalize()
+        if algorithm_name == "3DES":
+            key = key[:24]
+        return CryptoFunctions.cipherAlgorithm(key, algorithm_name, digest_mode)
+
     @staticmethod
     def validateKey(key, digest_mode, size):
         """
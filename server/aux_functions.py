@@ -1,6 +1,8 @@
 
-import json
 import datetime
+import hashlib
+import hmac
+import logging
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization
 
@@ -10,9 +12,16 @@ from crypto_functions import CryptoFunctions
 from cc import CitizenCard
 from pki import PKI
 
+logger = logging.getLogger('root')
+
 LICENSE_VIEWS = 4
 LICENSE_SPAN = datetime.timedelta(minutes=5)
 
+# Password digests, built once and copied on each registration
+# (same algorithms as CryptoFunctions.create_digest)
+HASHLIB_DIGESTS = {'SHA512': 'sha512_256', 'BLAKE2': 'blake2b'}
+DIGEST_OBJS = {digest: hashlib.new(HASHLIB_DIGESTS[digest]) for digest in CryptoFunctions.digests}
+
 def register(server, username, password, signature, signcert, intermedium):
     """
     This function handles the registration of a new user at server
@@ -32,7 +41,7 @@ def register(server, username, password, signature, signcert, intermedium):
 
     # Validate certificate
     if not server.pki.validateCerts(signcert, intermedium):
-        print("ERROR! The signature certificate is not valid!")
+        logger.warning("The signature certificate is not valid!")
         return None, "The signature certificate is not valid!"
 
     certificate = PKI.getCertFromString(signcert, pem=False)
@@ -44,21 +53,16 @@ def register(server, username, password, signature, signcert, intermedium):
         sign = signature.encode('latin')
     )
     if not valid:
-        print("ERROR! The signature is not valid!")
+        logger.warning("The signature is not valid!")
         return None, "The signature is not valid!"
 
     # Load users
-    usersfile = server.getFile('./licenses.json')
-    if not usersfile:
-        users = []
-    else:
-        users = json.loads(usersfile)
+    users_by_name = server.getUsers()
 
     # Check that user is not registered yet
-    for u in users:
-        if u['username'] == username:
-            print("ERROR! User already exists!")
-            return None, "The username given is already being used! Please choose other."
+    if username in users_by_name:
+        logger.warning("User already exists!")
+        return None, "The username given is already being used! Please choose other."
 
     # Create user
     user = {
@@ -69,15 +73,19 @@ def register(server, username, password, signature, signcert, intermedium):
         'cert': certificate.public_bytes(serialization.Encoding.DER).decode('latin')
     }
 
-    # Create digests for password
+    # Create digests for password (hex encoded)
+    password_bytes = password.encode('latin')
     for digest in CryptoFunctions.digests:
-        user['passwords'][digest] = CryptoFunctions.create_digest(password.encode('latin'), digest).decode('latin')
+        h = DIGEST_OBJS[digest].copy()
+        h.update(password_bytes)
+        user['passwords'][digest] = h.hexdigest()
 
-    # Add user to users list
-    users.append(user)
+    # Add user to users index
+    users_by_name[username] = user
+    server.users_keys[username] = certificate.public_key()
 
     # Update file
-    server.updateFile('./licenses.json', json.dumps(users))
+    server.saveUser(user)
 
     return user, ""
 
@@ -87,19 +95,8 @@ def getLicense(server, username):
     - Parameters
     server          MediaServer     The server that calls the method
     """
-    # Load users
-    usersfile = server.getFile('./licenses.json')
-    if not usersfile:
-        users = []
-    else:
-        users = json.loads(usersfile)
-
-    # Find user on file
-    for u in users:
-        if u['username'] == username:
-            return u
-
-    return None
+    # Find user on users index
+    return server.getUsers().get(username)
 
 def licenseValid(server, username):
     """
@@ -132,34 +129,21 @@ def updateLicense(server, username, renew = False, view = False):
     """
     if not username: return None
 
-    # Load users
-    usersfile = server.getFile('./licenses.json')
-    if not usersfile:
-        users = []
-    else:
-        users = json.loads(usersfile)
-
-    # Find user on file
-    user = None
-    userindex = 0
-    for u in users:
-        if u['username'] == username:
-            user = u
-            break
-        userindex += 1
-
+    # Find user on users index
+    user = server.getUsers().get(username)
     if not user: return None
 
-    # Renew license
-    if renew:
-        user['views'] = LICENSE_VIEWS
-        user['time'] = (datetime.datetime.now() + LICENSE_SPAN).timestamp()
-    elif view:
-        user['views'] = user['views'] - 1
-    
-    # Update users list (and file)
-    users[userindex] = user
-    server.updateFile('./licenses.json', json.dumps(users))
+    # Update and save the user at once (downloads update licenses on other threads)
+    with server.users_lock:
+        # Renew license
+        if renew:
+            user['views'] = LICENSE_VIEWS
+            user['time'] = (datetime.datetime.now() + LICENSE_SPAN).timestamp()
+        elif view:
+            user['views'] = user['views'] - 1
+
+        # Update file
+        server.saveUser(user)
 
     return user
 
@@ -169,40 +153,38 @@ def authenticate(server, username, password, signature, sessionData):
     --- Parameters
     server          MediaServer     The server that calls the method
     username        String
-    password        String (digest)
+    password        String (hex digest)
     signature       String          The username+password signature
     sessionData     The session data
     --- Returns
     userData        The object with user info at licenses.json
     error           The error message
     """
-    # Load users
-    usersfile = server.getFile('./licenses.json')
-    if not usersfile:
-        users = []
-    else:
-        users = json.loads(usersfile)
-    
     # Find user object
-    for u in users:
-        if u['username'] == username:
-            # Validate signature with user stored certificate 
-            cert = x509.load_der_x509_certificate(u['cert'].encode('latin'))
-            valid = CitizenCard.validateSignature(
-                public_key = cert.public_key(), 
-                message = (username+password).encode('latin'),
-                sign = signature.encode('latin')
-            )
-            if not valid:
-                return None, "The signature is not valid!"
-                
-            # Check password            
-            if u['passwords'][sessionData['digest']] == password:
-                return u, ""
-            else:
-                print("Password is not valid! :/")
-                return None, ""
+    u = server.getUsers().get(username)
 
     # If not found, return None
-    print("User not found...")
-    return None, ""
\ No newline at end of file
+    if not u:
+        logger.info("User not found...")
+        return None, ""
+
+    # Validate signature with user stored certificate (parsed once per user)
+    public_key = server.users_keys.get(username)
+    if public_key is None:
+        public_key = x509.load_der_x509_certificate(u['cert'].encode('latin')).public_key()
+        server.users_keys[username] = public_key
+    valid = CitizenCard.validateSignature(
+        public_key = public_key, 
+        message = (username+password).encode('latin'),
+        sign = signature.encode('latin')
+    )
+    if not valid:
+        return None, "The signature is not valid!"
+        
+    # Check password (in constant time)
+    stored = u['passwords'].get(sessionData['digest'], '')
+    if hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8')):
+        return u, ""
+    else:
+        logger.info("Password is not valid! :/")
+        return None, ""
\ No newline at end of file
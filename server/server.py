@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 from twisted.web import server, resource
+from twisted.web.http_headers import Headers
 from twisted.internet import reactor, defer
+from twisted.internet.threads import deferToThread
+from twisted.internet.task import LoopingCall
 import logging
-import binascii
-import json
+import orjson
 import os
 import math
 import uuid
 import base64
 import datetime
+import threading
+import queue
 from aux_functions import *
 
 # Serialization
@@ -27,7 +31,7 @@ from pki import PKI
 logger = logging.getLogger('root')
 FORMAT = "[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
 logging.basicConfig(format=FORMAT)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO)
 
 CATALOG = { '898a08080d1840793122b7e118b27a95d117ebce': 
             {
@@ -41,31 +45,173 @@ CATALOG = { '898a08080d1840793122b7e118b27a95d117ebce':
         }
 
 CATALOG_BASE = 'catalog'
-CHUNK_SIZE = 1024 * 4  #block
+CHUNK_SIZE = 1024 * 64  #block
+# Chunk ids are sent as 4 bytes appended to the shared key
+CHUNK_ID_LIMIT = 2 ** 32
 FILEPRIVATEKEY = '../keys/server_localhost.pem'
 FILECERTIFICATE = '../certificates/server_localhost.crt'
 SESSIONEXPIRES = datetime.timedelta(hours=2)
+KEYPOOLSIZE = 32
+COMPACTINTERVAL = datetime.timedelta(minutes=5)
+
+# Protocols response never changes, so it is serialized once
+PROTOCOLS = orjson.dumps(CryptoFunctions.suites)
+
+# Pre-compute number of chunks of each media
+for media in CATALOG.values():
+    media['chunks'] = math.ceil(media['file_size'] / CHUNK_SIZE)
 
 # Load server key
 with open('key.txt') as f:
     KEY = f.read().strip()
 
-class MediaServer(resource.Resource):
+class ThreadedRequest:
+    """
+    This class stands for a request while its handler runs on the reactor thread pool
+    Twisted requests are not thread safe, so the response code and headers are kept
+    here and only set on the request, on the reactor thread, by apply
+    Everything else is read from the request itself
+    """
+    def __init__(self, request):
+        self.request = request
+        self.responseHeaders = Headers()
+        self.code = None
+
+    def __getattr__(self, name):
+        return getattr(self.request, name)
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def apply(self):
+        """
+        Sets the response code and headers on the request (on the reactor thread)
+        """
+        for name, values in self.responseHeaders.getAllRawHeaders():
+            for value in values:
+                self.request.responseHeaders.addRawHeader(name, value)
+        if self.code is not None:
+            self.request.setResponseCode(self.code)
+
+class Endpoint(resource.Resource):
+    """
+    This class handles the requests to a single API endpoint (/api/<endpoint>)
+    Twisted routes each request to its endpoint with a children lookup
+    """
     isLeaf = True
 
+    def __init__(self, GET = None, POST = None, threaded = False):
+        """
+        --- Parameters
+        GET             Method that handles a GET request and returns the response
+        POST            Method that handles a POST request and returns the response
+        threaded        If POST must be handled on the reactor thread pool
+        """
+        resource.Resource.__init__(self)
+        self.GET = GET
+        self.POST = POST
+        self.threaded = threaded
+
+    # Handle a GET request
+    def render_GET(self, request):
+        logger.debug('Received request for %s', request.uri)
+
+        try:
+            if self.GET:
+                return self.GET(request)
+            request.responseHeaders.addRawHeader(b"content-type", b'text/plain')
+            return b'Methods: /api/protocols /api/list /api/download'
+
+        except Exception as e:
+            logger.exception(e)
+            request.setResponseCode(500)
+            request.responseHeaders.addRawHeader(b"content-type", b"text/plain")
+            return b''
+
+    # Handle a POST request
+    def render_POST(self, request):
+        logger.debug('Received POST for %s', request.uri)
+        try:
+            if not self.POST:
+                request.responseHeaders.addRawHeader(b"content-type", b'text/plain')
+                return b'Methods: /api/protocols /api/list /api/download'
+            if self.threaded:
+                return self.deferRequest(request, self.POST)
+            return self.POST(request)
+        
+        except Exception as e:
+            logger.exception(e)
+            request.setResponseCode(501)
+            request.responseHeaders.addRawHeader(b"content-type", b"text/plain")
+            return b''
+
+    def deferRequest(self, request, handler):
+        """
+        This method runs a request handler on the reactor thread pool,
+        so that the reactor keeps serving other clients meanwhile
+        The handler gets a ThreadedRequest, and the response is written
+        (with its code and headers) on the reactor thread once the handler finishes
+        --- Parameters
+        request
+        handler         Method that handles the request and returns the response
+        --- Returns
+        NOT_DONE_YET
+        """
+        # Do not write to requests whose connection was lost meanwhile
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        threaded_request = ThreadedRequest(request)
+
+        def write(response):
+            if finished: return
+            threaded_request.apply()
+            if response:
+                request.write(response)
+            request.finish()
+
+        def fail(failure):
+            logger.error(failure.getTraceback())
+            if finished: return
+            request.setResponseCode(501)
+            request.responseHeaders.addRawHeader(b"content-type", b"text/plain")
+            request.finish()
+
+        deferToThread(handler, threaded_request).addCallbacks(write, fail)
+        return server.NOT_DONE_YET
+
+class Router(resource.Resource):
+    """
+    This class holds child resources and answers unknown paths with the available methods
+    """
+    def getChild(self, path, request):
+        return Endpoint()
+
+    def render(self, request):
+        return Endpoint().render(request)
+
+class MediaServer(Router):
+
     # Constructor
     def __init__(self):
+        Router.__init__(self)
         print("\nInitializing server...")
 
         # Load parameters
         with open('parameters', 'rb') as f:
             self.parameters = serialization.load_pem_parameters(f.read().strip())    
+        # Serialize the parameters response once, as it never changes
+        self.parameters_response = orjson.dumps({'parameters': self.parameters.parameter_bytes(
+            encoding = serialization.Encoding.PEM,
+            format = serialization.ParameterFormat.PKCS3
+        ).decode('utf-8')})
 
-        # Load media files
+        # Load media files (split in chunks, so downloads just pick one)
         self.MEDIA = dict()
         print("\nLoading media...")
         for _, c in CATALOG.items():
-            self.MEDIA[c['file_name']] = self.getFile(os.path.join(CATALOG_BASE, c['file_name'])).encode('latin')
+            media = self.getFile(os.path.join(CATALOG_BASE, c['file_name'])).encode('latin')
+            self.MEDIA[c['file_name']] = [media[offset:offset+CHUNK_SIZE] for offset in range(0, len(media), CHUNK_SIZE)]
 
         # Load private key
         fp = open(FILEPRIVATEKEY, 'rb')
@@ -79,13 +225,41 @@ class MediaServer(resource.Resource):
         fc = open(FILECERTIFICATE, "rb")
         self.cert = PKI.getCertFromString(fc.read(), pem=True)
         fc.close()
+        # Certificate header sent on every response
+        self.cert_header = base64.b64encode(self.cert.public_bytes(encoding = serialization.Encoding.PEM))
 
         # Initialize session dictionary
         self.sessions = {}
 
+        # Users index (username -> user), loaded on first use
+        self.users_by_name = None
+        # Public keys of users certificates (username -> key), kept in memory only
+        self.users_keys = {}
+        # Downloads run on the thread pool, so users must be loaded, updated and saved
+        # by one thread at a time (reentrant, as updates hold it while saving)
+        self.users_lock = threading.RLock()
+
         # Initialize pki
         self.pki = PKI()
 
+        # Pre-generate DH key pairs for new sessions on a background thread
+        self.keypool = queue.Queue(maxsize=KEYPOOLSIZE)
+        threading.Thread(target=self.fillKeyPool, daemon=True).start()
+
+        # Register API endpoints
+        api = Router()
+        self.putChild(b'api', api)
+        api.putChild(b'parameters', Endpoint(GET = self.do_parameters))
+        api.putChild(b'protocols', Endpoint(GET = self.do_choose_protocols))
+        api.putChild(b'list', Endpoint(GET = self.do_list))
+        api.putChild(b'license', Endpoint(GET = self.do_license))
+        api.putChild(b'session', Endpoint(POST = self.do_session))
+        api.putChild(b'newuser', Endpoint(POST = lambda request: self.do_auth(request, registration=True)))
+        api.putChild(b'auth', Endpoint(POST = self.do_auth))
+        api.putChild(b'sessionend', Endpoint(POST = self.do_session_end))
+        api.putChild(b'renew', Endpoint(POST = self.do_renew_license))
+        api.putChild(b'download', Endpoint(POST = self.do_download, threaded = True))
+
         print("\nServer has been started!")
 
     # Send the server DH parameters
@@ -96,15 +270,10 @@ class MediaServer(resource.Resource):
                 request = request,
                 response = {'error': 'The client certificate is not valid!'}
             )
-        # Convert parameters to bytes
-        pr = self.parameters.parameter_bytes(
-            encoding = serialization.Encoding.PEM,
-            format = serialization.ParameterFormat.PKCS3
-        )
-        # Return it
+        # Return parameters (serialized at startup)
         return self.rawResponse(
             request = request,
-            response = {'parameters': pr.decode('utf-8')}
+            response = self.parameters_response
         )
 
     # Send the list of available protocols
@@ -118,7 +287,7 @@ class MediaServer(resource.Resource):
         # Return protocols available
         return self.rawResponse(
             request = request,
-            response = CryptoFunctions.suites
+            response = PROTOCOLS
         )
 
 
@@ -152,7 +321,7 @@ class MediaServer(resource.Resource):
                 'id': media_id,
                 'name': media['name'],
                 'description': media['description'],
-                'chunks': math.ceil(media['file_size'] / CHUNK_SIZE),
+                'chunks': media['chunks'],
                 'duration': media['duration']
             })
 
@@ -189,32 +358,6 @@ class MediaServer(resource.Resource):
             sessioninfo = session
         )
 
-    # Handle a GET request
-    def render_GET(self, request):
-        logger.debug(f'\nReceived request for {request.uri}')
-
-        try:
-            if request.path == b'/api/parameters':
-                return self.do_parameters(request)
-            elif request.path == b'/api/protocols':
-                return self.do_choose_protocols(request)
-            #elif request.uri == 'api/key':
-            #...
-            #elif request.uri == 'api/auth':
-            elif request.path == b'/api/list':
-                return self.do_list(request)
-            elif request.path == b'/api/license':
-                return self.do_license(request)
-            else:
-                request.responseHeaders.addRawHeader(b"content-type", b'text/plain')
-                return b'Methods: /api/protocols /api/list /api/download'
-
-        except Exception as e:
-            logger.exception(e)
-            request.setResponseCode(500)
-            request.responseHeaders.addRawHeader(b"content-type", b"text/plain")
-            return b''
-        
     """
     This method allows the client to start a new session at the server 
     --- Start
@@ -239,11 +382,15 @@ class MediaServer(resource.Resource):
         # 2. Generate a session id for client
         sessionid = uuid.uuid1()
 
-        # 3. Generate key pair for client
-        private_key, public_key = CryptoFunctions.newKeys(self.parameters)
+        # 3. Get a key pair for client (pre-generated)
+        private_key, public_key = self.keypool.get()
 
         # 4. Diffie-Hellman | Generate shared key
         shared_key = private_key.exchange(client_public_key)
+        # 4.1. Build the cipher (and its key) once for the whole session
+        algorithm = CryptoFunctions.cipherAlgorithm(shared_key, CIPHER, DIGEST)
+        # 4.2. Digest the shared key once, to derive the keys with bytes appended
+        key_context = CryptoFunctions.digestContext(shared_key, DIGEST)
 
         # 5. Convert public key to bytes
         pk = public_key.public_bytes(
@@ -256,6 +403,8 @@ class MediaServer(resource.Resource):
             'public_key': public_key,
             'private_key': private_key,
             'shared_key': shared_key,
+            'algorithm': algorithm,
+            'key_context': key_context,
             'cipher': CIPHER,
             'digest': DIGEST,
             'mode': CIPHER_MODE,
@@ -450,10 +599,19 @@ class MediaServer(resource.Resource):
                 error=True,
             )
 
-        logger.debug(f'Download: args: {request.args}')
-        
+        # Check if the chunk id is valid (it is also used on the key to cipher)
+        chunk_id = data['chunk']
+        if type(chunk_id) != int or not 0 <= chunk_id < CHUNK_ID_LIMIT:
+            return self.cipherResponse(
+                request = request, 
+                response = {'error': 'invalid chunk id'}, 
+                sessioninfo = session,
+                error = True
+            )
+        append = chunk_id.to_bytes(4, 'big')
+
         media_id = data['media']
-        logger.debug(f'Download: id: {media_id}')
+        logger.debug('Download: id: %s', media_id)
 
         # Check if the media_id is not None as it is required
         if media_id is None:
@@ -461,7 +619,7 @@ class MediaServer(resource.Resource):
                 request = request, 
                 response = {'error': 'invalid media id'}, 
                 sessioninfo = session,
-                append = bytes(chunk_id),
+                append = append,
                 error = True
             )
         
@@ -471,23 +629,22 @@ class MediaServer(resource.Resource):
                 request = request, 
                 response = {'error': 'media file not found'}, 
                 sessioninfo = session,
-                append = bytes(chunk_id),
+                append = append,
                 error = True
             )
         
         # Get the media item
         media_item = CATALOG[media_id]
 
-        # Check if a chunk is valid
-        chunk_id = data['chunk']
-        valid_chunk = False
-        try:
-            if chunk_id >= 0 and chunk_id  < math.ceil(media_item['file_size'] / CHUNK_SIZE):
-                valid_chunk = True
-                #if is valid chunck update_license
-                media_duration= media_item['duration']
-        except:
-            logger.warn("Chunk format is invalid")
+        # Check that chunk exists on media
+        if chunk_id >= media_item['chunks']:
+            return self.cipherResponse(
+                request = request, 
+                response = {'error': 'invalid chunk id'}, 
+                sessioninfo = session,
+                append = append,
+                error = True
+            )
 
         # Update license for first chunk (decrement views)
         if chunk_id==0:
@@ -497,98 +654,58 @@ class MediaServer(resource.Resource):
                     request = request,
                     response = {'error': 'There was an error updating the license. Try again!'},
                     sessioninfo = session,
+                    append = append,
                     error = True
                 )
-
-        if not valid_chunk:
-            return self.cipherResponse(
-                request = request, 
-                response = {'error': 'invalid chunk id'}, 
-                sessioninfo = session,
-                append = bytes(chunk_id),
-                error = True
-            )
             
-            
-        logger.debug(f'Download: chunk: {chunk_id}')
-
-        offset = chunk_id * CHUNK_SIZE
-
-        # Open file, seek to correct position and return the chunk
-        data = self.MEDIA[media_item['file_name']][offset:offset+CHUNK_SIZE]
-        message = {
-            'media_id': media_id, 
-            'chunk': chunk_id, 
-            'data': binascii.b2a_base64(data).decode('latin').strip()
-        }
-        return self.cipherResponse(
-            request = request, 
-            response = message, 
-            sessioninfo = session,
-            append = bytes(chunk_id)
-        )
+        logger.debug('Download: chunk: %s', chunk_id)
 
-        # File was not open?
+        # Get the chunk and return it as raw bytes
+        data = self.MEDIA[media_item['file_name']][chunk_id]
+        request.responseHeaders.addRawHeader(b"x-media-id", media_id.encode('latin'))
+        request.responseHeaders.addRawHeader(b"x-chunk-id", str(chunk_id).encode('latin'))
         return self.cipherResponse(
             request = request, 
-            response = {'error': 'unknown'}, 
+            response = data, 
             sessioninfo = session,
-            append = bytes(chunk_id),
-            error = True
+            append = append,
+            content_type = b"application/octet-stream"
         )
 
-
-    # Handle a POST request
-    def render_POST(self, request):
-        logger.debug(f'\nReceived POST for {request.uri}')
-        try:
-            if request.path == b'/api/session':
-                return self.do_session(request)
-            elif request.path == b'/api/newuser':
-                return self.do_auth(request, registration=True)
-            elif request.path == b'/api/auth':
-                return self.do_auth(request)
-            elif request.path == b'/api/sessionend':
-                return self.do_session_end(request)
-            elif request.path == b'/api/renew':
-                return self.do_renew_license(request)
-            elif request.path == b'/api/download':
-                return self.do_download(request)
-        
-        except Exception as e:
-            logger.exception(e)
-            request.setResponseCode(501)
-            request.responseHeaders.addRawHeader(b"content-type", b"text/plain")
-            return b''
-
     # Responses processing
-    def cipherResponse(self, request, response, sessioninfo, append = None, error = False):
+    def cipherResponse(self, request, response, sessioninfo, append = None, error = False, content_type = b"application/json"):
         """
         This method ciphers a response to a request
         It also generates a MIC for the cryptogram
         --- Parameters
         request     
-        response        A Python object to send encrypted as response
+        response        A Python object (or raw bytes) to send encrypted as response
         sessioninfo     Client session data
-        append          Bytes to append to shared_key before ciphering
+        append          Bytes appended to shared_key to get the key for ciphering
         error           If error, set response code to 400
+        content_type    The response content type
         --- Returns
         cryptogram      The response encrypted
         """
         if not response or not sessioninfo: return None
-        # Convert Python Object to str and then to bytes
-        message = json.dumps(response).encode()
+        # Convert Python Object to bytes (raw bytes are sent as they are)
+        message = response if type(response) == bytes else orjson.dumps(response)
+        # Get cipher for the key (shared_key, or shared_key + append)
+        if not append:
+            algorithm = sessioninfo['algorithm']
+        else:
+            algorithm = CryptoFunctions.appendedCipherAlgorithm(sessioninfo['key_context'], append, sessioninfo['cipher'], sessioninfo['digest'])
         # Encrypt
         cryptogram = CryptoFunctions.symetric_encryption(
-            key = sessioninfo['shared_key'] if not append else sessioninfo['shared_key'] + append,
             message = message,
             algorithm_name = sessioninfo['cipher'],
             cypher_mode = sessioninfo['mode'],
             digest_mode = sessioninfo['digest'],
-            encode = True
+            encode = True,
+            algorithm = algorithm
         )
         # Generate MIC
-        MIC = CryptoFunctions.create_digest(cryptogram, sessioninfo['digest'])
+        MIC = CryptoFunctions.create_mic(cryptogram, sessioninfo['digest'], sessioninfo['mode'])
         MAC = CryptoFunctions.create_digest(cryptogram+sessioninfo['shared_key'], sessioninfo['digest'])
         # Sign request with private key
         SIGN = CryptoFunctions.signingRSA(cryptogram, self.private_key)
@@ -596,9 +713,9 @@ class MediaServer(resource.Resource):
         request.responseHeaders.addRawHeader(b"mic", base64.b64encode(MIC))
         request.responseHeaders.addRawHeader(b"mac", base64.b64encode(MAC))
         request.responseHeaders.addRawHeader(b"signature", base64.b64encode(SIGN))
-        request.responseHeaders.addRawHeader(b"certificate", base64.b64encode(self.cert.public_bytes(encoding = serialization.Encoding.PEM)))
+        request.responseHeaders.addRawHeader(b"certificate", self.cert_header)
         request.responseHeaders.addRawHeader(b"ciphered", b"True")
-        request.responseHeaders.addRawHeader(b"content-type", b"application/json")
+        request.responseHeaders.addRawHeader(b"content-type", content_type)
         if error:
             request.setResponseCode(400)
         # Return cryptogram
@@ -610,14 +727,14 @@ class MediaServer(resource.Resource):
         It also generates a pseudo MIC (hash) for the cryptogram
         --- Parameters
         request     
-        response        A Python object to send encrypted as response
+        response        A Python object (or its JSON bytes) to send as response
         error           If error, set response code to 400
         --- Returns
         cryptogram      The response encrypted
         """
         if not response: return None
-        # Convert Python Object to str and then to bytes
-        message = json.dumps(response).encode().strip()
+        # Convert Python Object to bytes (serialized responses are sent as they are)
+        message = response if type(response) == bytes else orjson.dumps(response)
         # Generate pseudo MIC
         MIC = str(str(message).__hash__()).encode('latin')
         # Sign request with private keya
@@ -625,7 +742,7 @@ class MediaServer(resource.Resource):
         # Add headers
         request.responseHeaders.addRawHeader(b"mic", base64.b64encode(MIC))
         request.responseHeaders.addRawHeader(b"signature", base64.b64encode(SIGN))
-        request.responseHeaders.addRawHeader(b"certificate", base64.b64encode(self.cert.public_bytes(encoding = serialization.Encoding.PEM)))
+        request.responseHeaders.addRawHeader(b"certificate", self.cert_header)
         request.responseHeaders.addRawHeader(b"ciphered", b'False')
         request.responseHeaders.addRawHeader(b"content-type", b"application/json")
         if error:
@@ -658,7 +775,7 @@ class MediaServer(resource.Resource):
         
         # Get MIC and validate it
         RMIC = base64.b64decode(headers[b'mic'])
-        MIC = CryptoFunctions.create_digest(request.content.getvalue().strip(), session['digest']).strip()
+        MIC = CryptoFunctions.create_mic(request.content.getvalue().strip(), session['digest'], session['mode']).strip()
         if MIC != RMIC:
             return None, None
 
@@ -669,14 +786,14 @@ class MediaServer(resource.Resource):
 
         # Decipher request
         message = CryptoFunctions.symetric_encryption( 
-            key = session['shared_key'], 
             message = request.content.getvalue(), 
             algorithm_name = session['cipher'], 
             cypher_mode = session['mode'], 
             digest_mode = session['digest'], 
-            encode = False 
+            encode = False,
+            algorithm = session['algorithm']
         ) 
-        return session, json.loads(message)
+        return session, orjson.loads(message)
 
     # Process client certificates
     def processRequestCertificate(self, request):
@@ -690,19 +807,27 @@ class MediaServer(resource.Resource):
         # Validate certificate
         cert =  base64.b64decode(headers[b'cert']).decode('latin')
         if not self.pki.validateCerts(cert, [], pem=True):
-            print("ERROR! The client certificate is not valid!")
+            logger.warning("The client certificate is not valid!")
             return False
         
         # Validate signature!
         cert = self.pki.getCertFromString(cert, pem=True) 
         sign = base64.b64decode(headers[b'signature']) 
-        signMessage = request.content.getvalue() if request.content.getvalue() else json.dumps(dict()).encode('latin')
+        signMessage = request.content.getvalue() if request.content.getvalue() else orjson.dumps(dict())
         if not CryptoFunctions.validacaoAssinatura_RSA(sign, signMessage, cert.public_key()):
-            print("\nERROR! The client signature is not valid!")
+            logger.warning("The client signature is not valid!")
             return False
         return True        
 
     # Session management
+    def fillKeyPool(self):
+        """
+        This method keeps the pool of DH key pairs full
+        It runs forever, on a daemon thread
+        """
+        while True:
+            self.keypool.put(CryptoFunctions.newKeys(self.parameters))
+
     def getSession(self, request):
         """
         This method gets the session for the token sent on request header
@@ -712,12 +837,12 @@ class MediaServer(resource.Resource):
         headers = request.getAllHeaders()
         sessionid = uuid.UUID(bytes=base64.b64decode(headers[b'sessionid']))
         if sessionid not in self.sessions.keys():
-            print(f"\nSession is not valid! ({sessionid})")
+            logger.warning("Session is not valid! (%s)", sessionid)
             return None
         session = self.sessions[sessionid]
         # If session exists, check if has already expired
         if session['created']+SESSIONEXPIRES < datetime.datetime.now():
-            print(f"\nSession has expired! ({sessionid})")
+            logger.warning("Session has expired! (%s)", sessionid)
             return None
         return session
 
@@ -747,6 +872,55 @@ class MediaServer(resource.Resource):
             ), None
         return None, session
 
+    # Users management
+    def getUsers(self):
+        """
+        This method returns the users index, loading it on first use
+        from licenses.json and the user updates logged after it (licenses.log)
+        - Returns
+        users           dict()      The users by username
+        """
+        with self.users_lock:
+            if self.users_by_name is None:
+                usersfile = self.getFile('./licenses.json')
+                users = orjson.loads(usersfile.encode('latin')) if usersfile else []
+                self.users_by_name = {u['username']: u for u in users}
+                # Drop a line left incomplete by a crash, so that new lines are appended after it
+                self.repairFileLines('./licenses.log')
+                # Replay updates, the last one of each user wins
+                for line in self.getFileLines('./licenses.log'):
+                    try:
+                        user = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        logger.warning("Skipping invalid line at licenses.log")
+                        continue
+                    self.users_by_name[user['username']] = user
+        return self.users_by_name
+
+    def saveUser(self, user):
+        """
+        This method persists a new or updated user, appending it to licenses.log
+        """
+        with self.users_lock:
+            self.appendFile('./licenses.log', orjson.dumps(user))
+
+    def compactUsers(self):
+        """
+        This method rewrites licenses.json with the users index and empties licenses.log
+        It is called periodically, so errors are logged (and compaction is tried again later)
+        """
+        try:
+            users = self.getUsers()
+            with self.users_lock:
+                # Nothing changed since last compaction
+                if not os.path.exists('./licenses.log'):
+                    return
+                # licenses.json is replaced at once, so the log is only removed once it is saved
+                self.updateFile('./licenses.json', orjson.dumps(list(users.values())))
+                os.remove('./licenses.log')
+        except Exception:
+            logger.exception("Could not compact licenses.log")
+
     # Server files
     def getFile(self, location):
         """
@@ -773,26 +947,98 @@ class MediaServer(resource.Resource):
         Loads the content of an encripted file at server 
         - Parameters
         location        String      The file location
-        content         String      The content to update with
+        content         String/Bytes The content to update with
         - Returns
         content         String      The file decripted
         """
         # Generate cryptogram
         cryptogram = CryptoFunctions.symetric_encryption(
             key = KEY.encode('latin'),
-            message = content.encode('latin'),
+            message = content if type(content) == bytes else content.encode('latin'),
+            algorithm_name = "AES",
+            digest_mode = "SHA512",
+            cypher_mode = "CBC",
+            encode = True
+        )
+        # Save to a temporary file and replace the file with it,
+        # so that the file is never left half written
+        temporary = location + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(cryptogram)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, location)
+
+    def getFileLines(self, location):
+        """
+        Loads a file of encrypted lines (see appendFile) at server folder
+        - Parameters
+        location        String      The file location
+        - Returns
+        lines           Bytes[]     The lines decripted
+        """
+        if not os.path.exists(location):
+            return []
+        lines = []
+        for line in open(location, 'rb'):
+            try:
+                lines.append(CryptoFunctions.symetric_encryption(
+                    key = KEY.encode('latin'),
+                    message = base64.b64decode(line.strip(), validate=True),
+                    algorithm_name = "AES",
+                    digest_mode = "SHA512",
+                    cypher_mode = "CBC",
+                    encode = False
+                ))
+            except (ValueError, IndexError):
+                # A line may be left incomplete if the server stopped while writing it
+                logger.warning("Skipping invalid line at %s", location)
+        return lines
+
+    def repairFileLines(self, location):
+        """
+        Truncates a file of encrypted lines (see appendFile) after its last complete line
+        A line is left incomplete if the server stopped while writing it
+        - Parameters
+        location        String      The file location
+        """
+        if not os.path.exists(location):
+            return
+        with open(location, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b'\n'):
+                logger.warning("Removing incomplete line at %s", location)
+                f.truncate(content.rfind(b'\n') + 1)
+
+    def appendFile(self, location, content):
+        """
+        Appends content to a file of encrypted lines at server
+        Each line is encrypted on its own and base64 encoded
+        - Parameters
+        location        String      The file location
+        content         Bytes       The content to append
+        """
+        # Generate cryptogram
+        cryptogram = CryptoFunctions.symetric_encryption(
+            key = KEY.encode('latin'),
+            message = content,
             algorithm_name = "AES",
             digest_mode = "SHA512",
             cypher_mode = "CBC",
             encode = True
         )
-        # Save to file
-        open(location, 'wb').write(cryptogram)
+        # Append to file
+        with open(location, 'ab') as f:
+            f.write(base64.b64encode(cryptogram) + b'\n')
         
 
 print("Server started")
 print("URL is: http://IP:8080")
 
-s = server.Site(MediaServer())
+media_server = MediaServer()
+s = server.Site(media_server)
+reactor.suggestThreadPoolSize(os.cpu_count() * 2)
+# Compact the licenses log periodically, off the reactor thread
+LoopingCall(deferToThread, media_server.compactUsers).start(COMPACTINTERVAL.total_seconds(), now=False)
 reactor.listenTCP(8080, s)
 reactor.run()
\ No newline at end of file